@@ -10,7 +10,7 @@ import torch
 def recompute_bnorm(cfg, net):
     stream_loader = StreamLoader()
     stream_parser = StreamParser(cfg.down_sample_rate)
-    batch_gen = BatchGenerator(cfg.boardsize, cfg.input_channels)
+    batch_gen = BatchGenerator(cfg.boardsize, cfg.input_channels, cfg.use_gpu)
 
     lazy_loader = LazyLoader(
         filenames = gather_filenames(cfg.train_dir),
@@ -42,13 +42,13 @@ def recompute_bnorm(cfg, net):
 
         # Move to the current device.
         if cfg.use_gpu:
-            planes = planes.to(device)
-            target_prob = target_prob.to(device)
-            target_aux_prob = target_aux_prob.to(device)
-            target_ownership = target_ownership.to(device)
-            target_wdl = target_wdl.to(device)
-            target_stm = target_stm.to(device)
-            target_score = target_score.to(device)
+            planes = planes.to(device, non_blocking=True)
+            target_prob = target_prob.to(device, non_blocking=True)
+            target_aux_prob = target_aux_prob.to(device, non_blocking=True)
+            target_ownership = target_ownership.to(device, non_blocking=True)
+            target_wdl = target_wdl.to(device, non_blocking=True)
+            target_stm = target_stm.to(device, non_blocking=True)
+            target_score = target_score.to(device, non_blocking=True)
 
         # gather batch data
         target = (target_prob, target_aux_prob, target_ownership, target_wdl, target_stm, target_score)
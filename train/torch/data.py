@@ -1,8 +1,27 @@
 import numpy as np
-from symmetry import numpy_symmetry_planes, numpy_symmetry_plane, numpy_symmetry_prob
+import math
+
+try:
+    # Compile the record parser if numba is installed. Otherwise use the
+    # pure python parser.
+    import numba
+except ImportError:
+    numba = None
 
 FIXED_DATA_VERSION = 1
 DATA_LINES = 45
+NUM_BINARY_PLANES = 34
+
+# Lookup table for decoding the binary features. Every hex char
+# stores four bits, the lowest bit is the first intersection.
+ASCII_TO_NIBBLE = np.zeros(256, dtype=np.uint8)
+ASCII_TO_NIBBLE[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+
+# Lookup table for decoding the ownership chars.
+OWN_LUT = np.zeros(256, dtype=np.int8)
+OWN_LUT[ord('1')] = 1
+OWN_LUT[ord('2')] = -2
+OWN_LUT[ord('3')] = -1
 
 '''
 ------- claiming -------
@@ -25,7 +44,204 @@ DATA_LINES = 45
 
 '''
 
+def _njit(func):
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+@_njit
+def _line_end(buf, start):
+    end = start
+    while end < buf.size and buf[end] != 10: # '\n'
+        end += 1
+    return end
+
+@_njit
+def _parse_int(buf, start, end):
+    if start >= end:
+        raise ValueError("The field is empty.")
+
+    i = start
+    sign = 1
+    if buf[i] == 45: # '-'
+        sign = -1
+        i += 1
+    elif buf[i] == 43: # '+'
+        i += 1
+
+    v = 0
+    while i < end and buf[i] >= 48 and buf[i] <= 57:
+        v = v * 10 + (np.int64(buf[i]) - 48)
+        i += 1
+    return sign * v
+
+@_njit
+def _parse_float(buf, start, end):
+    if start >= end:
+        raise ValueError("The field is empty.")
+
+    i = start
+    sign = 1.0
+    if buf[i] == 45: # '-'
+        sign = -1.0
+        i += 1
+    elif buf[i] == 43: # '+'
+        i += 1
+
+    mantissa = 0
+    scale = 0
+    while i < end and buf[i] >= 48 and buf[i] <= 57:
+        mantissa = mantissa * 10 + (np.int64(buf[i]) - 48)
+        i += 1
+    if i < end and buf[i] == 46: # '.'
+        i += 1
+        while i < end and buf[i] >= 48 and buf[i] <= 57:
+            mantissa = mantissa * 10 + (np.int64(buf[i]) - 48)
+            scale -= 1
+            i += 1
+    if i < end and (buf[i] == 101 or buf[i] == 69): # 'e' or 'E'
+        scale += _parse_int(buf, i+1, end)
+
+    if scale >= 0:
+        return sign * mantissa * 10.0 ** scale
+    return sign * mantissa / 10.0 ** (-scale)
+
+@_njit
+def _parse_probabilities(buf, start, end, num_intersections):
+    prob = np.zeros(num_intersections + 1, dtype=np.float32)
+
+    i = start
+    while i < end and buf[i] != 32: # ' '
+        i += 1
+    if i == end:
+        # Only the index of the played move.
+        index = _parse_int(buf, start, end)
+        if index < 0 or index > num_intersections:
+            raise ValueError("The probabilities are not correct.")
+        prob[index] = 1
+        return prob
+
+    size = 0
+    i = start
+    while i < end:
+        j = i
+        while j < end and buf[j] != 32:
+            j += 1
+        if j > i:
+            if size > num_intersections:
+                raise ValueError("The probabilities are not correct.")
+            prob[size] = _parse_float(buf, i, j)
+            size += 1
+        i = j + 1
+
+    if size != num_intersections + 1:
+        raise ValueError("The probabilities are not correct.")
+    return prob
+
+@_njit
+def _parse_v1(buf, ascii_to_nibble, own_lut):
+    # Parse one record from the raw bytes. See the data format above. There
+    # is no bounds check in the compiled code, so check every line width
+    # before reading it.
+    pos = 0
+    end = _line_end(buf, pos)
+    if _parse_int(buf, pos, end) != FIXED_DATA_VERSION:
+        raise ValueError("The data is not correct version.")
+
+    pos = _line_end(buf, end + 1) + 1 # skip the mode
+    end = _line_end(buf, pos)
+    board_size = _parse_int(buf, pos, end)
+    if board_size <= 0:
+        raise ValueError("The board size is not correct.")
+    num_intersections = board_size * board_size
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    komi = _parse_float(buf, pos, end)
+
+    size = num_intersections // 4
+    planes = np.empty((NUM_BINARY_PLANES, num_intersections), dtype=np.int8)
+    for p in range(NUM_BINARY_PLANES):
+        pos = end + 1
+        end = _line_end(buf, pos)
+        if end - pos != size + board_size % 2:
+            raise ValueError("The binary features are not correct.")
+        for k in range(size):
+            nibble = ascii_to_nibble[buf[pos + k]]
+            for b in range(4):
+                planes[p, 4 * k + b] = (nibble >> b) & 1
+        if board_size % 2 == 1:
+            planes[p, num_intersections - 1] = ascii_to_nibble[buf[pos + size]]
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    to_move = _parse_int(buf, pos, end)
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    prob = _parse_probabilities(buf, pos, end, num_intersections)
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    aux_prob = _parse_probabilities(buf, pos, end, num_intersections)
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    if end - pos != num_intersections:
+        raise ValueError("The ownership is not correct.")
+    ownership = np.empty(num_intersections, dtype=np.int8)
+    for k in range(num_intersections):
+        ownership[k] = own_lut[buf[pos + k]]
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    result = _parse_int(buf, pos, end)
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    q_value = _parse_float(buf, pos, end)
+
+    pos = end + 1
+    end = _line_end(buf, pos)
+    final_score = _parse_float(buf, pos, end)
+
+    return (
+        board_size, komi, planes, to_move,
+        prob, aux_prob, ownership, result, q_value, final_score
+    )
+
+def check_compiled_parser(datalines):
+    # Parse the record by both parsers and compare the results. The python
+    # parser is the reference, so its error is raised as usual.
+    expected = Data()
+    expected.parse_v1_python(datalines)
+
+    try:
+        data = Data()
+        data.parse_v1_compiled(datalines)
+
+        same = True
+        for attr in ["board_size", "to_move", "result"]:
+            same = same and getattr(data, attr) == getattr(expected, attr)
+        for attr in ["komi", "q_value", "final_score"]:
+            same = same and math.isclose(getattr(data, attr), getattr(expected, attr), rel_tol=1e-9)
+        for attr in ["planes", "ownership"]:
+            same = same and np.array_equal(getattr(data, attr), getattr(expected, attr))
+        for attr in ["prob", "aux_prob"]:
+            same = same and getattr(data, attr).shape == getattr(expected, attr).shape and \
+                       np.allclose(getattr(data, attr), getattr(expected, attr), rtol=1e-6, atol=0)
+    except Exception:
+        same = False
+
+    if not same:
+        print("The compiled parser does not match the python parser. Use the python parser.")
+    return same
+
 class Data():
+    # Whether to use the numba compiled parser. It is decided on
+    # the first parsed record.
+    use_compiled_parser = None
+
     def __init__(self):
         super().__init__()
         self.version = FIXED_DATA_VERSION
@@ -42,110 +258,70 @@ class Data():
         self.q_value = None
         self.final_score = None
 
-    def hex_to_int(self, h):
-        if h == '0':
-            return [0, 0, 0, 0]
-        elif h == '1':
-            return [1, 0, 0, 0]
-        elif h == '2':
-            return [0, 1, 0, 0]
-        elif h == '3':
-            return [1, 1, 0, 0]
-        elif h == '4':
-            return [0, 0, 1, 0]
-        elif h == '5':
-            return [1, 0, 1, 0]
-        elif h == '6':
-            return [0, 1, 1, 0]
-        elif h == '7':
-            return [1, 1, 1, 0]
-        elif h == '8':
-            return [0, 0, 0, 1]
-        elif h == '9':
-            return [1, 0, 0, 1]
-        elif h == 'a':
-            return [0, 1, 0, 1]
-        elif h == 'b':
-            return [1, 1, 0, 1]
-        elif h == 'c':
-            return [0, 0, 1, 1]
-        elif h == 'd':
-            return [1, 0, 1, 1]
-        elif h == 'e':
-            return [0, 1, 1, 1]
-        elif h == 'f':
-            return [1, 1, 1, 1]
-
-    def int2_to_int(self, v):
-        if v == '0':
-            return 0
-        elif v == '1':
-            return 1
-        elif v == '2':
-            return -2
-        elif v == '3':
-            return -1
-
-    def gether_binary_plane(self, board_size, readline):
-        plane = []
+    def gether_binary_planes(self, board_size, readlines):
+        # Decode all binary features at once. Every line has the
+        # same width, including the tail bit and the newline.
         size = (board_size * board_size) // 4
-        for i in range(size):
-            plane.extend(self.hex_to_int(readline[i]))
+        width = size + board_size % 2 + 1
 
-        if board_size % 2 == 1:
-            plane.append(int(readline[size]))
+        buf = np.frombuffer(''.join(readlines).encode('ascii'), dtype=np.uint8)
+        assert buf.size == len(readlines) * width, "The binary features are not correct."
+        buf = np.reshape(buf, (len(readlines), width))
 
-        plane = np.array(plane, dtype=np.int8)
-        return plane
+        nibbles = ASCII_TO_NIBBLE[buf[:, :size]]
+        planes = np.unpackbits(nibbles[:, :, None], axis=2, bitorder='little')[:, :, :4].reshape(len(readlines), -1)
 
-    def get_probabilities(self, board_size, readline):
-        value = readline.split()
-        prob = np.zeros(board_size * board_size + 1, dtype=np.float32)
+        if board_size % 2 == 1:
+            planes = np.concatenate((planes, ASCII_TO_NIBBLE[buf[:, size:size+1]]), axis=1)
+        return planes.view(np.int8)
 
-        if len(value) == 1:
-             index = int(value[0])
-             prob[index] = 1
+    def get_probabilities(self, board_size, readline):
+        if readline.strip().find(' ') < 0:
+            # Only the index of the played move.
+            prob = np.zeros(board_size * board_size + 1, dtype=np.float32)
+            prob[int(readline)] = 1
         else:
-             assert len(value) == board_size * board_size + 1, ""
-             for index in range(len(value)):
-                 prob[index] = float(value[index])
+            prob = np.fromstring(readline, sep=' ', dtype=np.float32)
+            assert prob.size == board_size * board_size + 1, ""
         return prob
 
     def get_ownership(self, board_size, readline):
-        ownership = np.zeros(board_size * board_size, dtype=np.int8)
-
-        for index in range(board_size * board_size):
-            ownership[index] = self.int2_to_int(readline[index])
-        return ownership
-
-    def fill_v1(self, linecnt, readline):
-        if linecnt == 0:
-            v = int(readline)
-            assert v == FIXED_DATA_VERSION, "The data is not correct version."
-        elif linecnt == 1:
-            m = int(readline)
-        elif linecnt == 2:
-            self.board_size = int(readline)
-        elif linecnt == 3:
-            self.komi = float(readline)
-        elif linecnt >= 4 and linecnt <= 37:
-            plane = self.gether_binary_plane(self.board_size, readline)
-            self.planes.append(plane)
-        elif linecnt == 38:
-            self.planes = np.array(self.planes)
-            self.to_move = int(readline)
-        elif linecnt == 39:
-            self.prob = self.get_probabilities(self.board_size, readline)
-        elif linecnt == 40:
-            self.aux_prob = self.get_probabilities(self.board_size, readline)
-        elif linecnt == 41:
-            self.ownership = self.get_ownership(self.board_size, readline)
-        elif linecnt == 42:
-            self.result = int(readline)
-        elif linecnt == 43:
-            self.q_value = float(readline)
-        elif linecnt == 44:
-            self.final_score = float(readline)
+        buf = np.frombuffer(readline.encode('ascii'), dtype=np.uint8)
+        return OWN_LUT[buf[:board_size * board_size]]
+
+    def parse_v1(self, datalines):
+        # Parse the whole record at once. Use the compiled parser once it
+        # agrees with the python parser on the first record.
+        if Data.use_compiled_parser is None:
+            Data.use_compiled_parser = numba is not None and \
+                                           check_compiled_parser(datalines)
+        if Data.use_compiled_parser:
+            self.parse_v1_compiled(datalines)
+        else:
+            self.parse_v1_python(datalines)
+
+    def parse_v1_python(self, datalines):
+        # The binary features are decoded in bulk.
+        v = int(datalines[0])
+        assert v == FIXED_DATA_VERSION, "The data is not correct version."
+
+        self.board_size = int(datalines[2])
+        self.komi = float(datalines[3])
+        self.planes = self.gether_binary_planes(self.board_size, datalines[4:38])
+        self.to_move = int(datalines[38])
+        self.prob = self.get_probabilities(self.board_size, datalines[39])
+        self.aux_prob = self.get_probabilities(self.board_size, datalines[40])
+        self.ownership = self.get_ownership(self.board_size, datalines[41])
+        self.result = int(datalines[42])
+        self.q_value = float(datalines[43])
+        self.final_score = float(datalines[44])
+
+    def parse_v1_compiled(self, datalines):
+        # Parse the record by the numba compiled parser.
+        buf = np.frombuffer(''.join(datalines).encode('ascii'), dtype=np.uint8)
+        self.board_size, self.komi, self.planes, self.to_move, \
+            self.prob, self.aux_prob, self.ownership, \
+            self.result, self.q_value, self.final_score = _parse_v1(buf, ASCII_TO_NIBBLE, OWN_LUT)
 
     @staticmethod
     def get_datalines(version):
@@ -153,21 +329,6 @@ class Data():
             return DATA_LINES
         return 0
 
-    def apply_symmetry(self, symm):
-        channels       = self.planes.shape[0]
-        bsize          = self.board_size
-
-        self.planes    = np.reshape(self.planes, (channels, bsize, bsize))
-        self.planes    = numpy_symmetry_planes(symm, self.planes)
-        self.planes    = np.reshape(self.planes, (channels, bsize * bsize))
-
-        self.ownership = np.reshape(self.ownership, (bsize, bsize))
-        self.ownership = numpy_symmetry_plane(symm, self.ownership)
-        self.ownership = np.reshape(self.ownership, (bsize * bsize))
-
-        self.prob      = numpy_symmetry_prob(symm, self.prob)
-        self.aux_prob  = numpy_symmetry_prob(symm, self.aux_prob)
-
     def __str__(self):
         out = str()
         out += "Board size: {}\n".format(self.board_size)
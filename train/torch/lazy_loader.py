@@ -1,7 +1,12 @@
 import multiprocessing as mp
 import threading
+import queue
 import random
 
+# The number of free slots every worker holds. The worker can parse the next
+# data while the last one is not received.
+SLOTS_PER_WORKER = 2
+
 class ShuffleBuffer:
     def __init__(self, buf_size):
         self.__buf = list()
@@ -24,12 +29,14 @@ class ShuffleBuffer:
         return item
 
 class DataLoader:
-    def __init__(self, filenames, data_writer, down_sample_rate, stream_loader, stream_parser):
+    def __init__(self, filenames, data_writer, down_sample_rate, stream_loader, stream_parser, batch_generator, storage):
         self.done = filenames
         self.tasks = list()
 
         self.parser = stream_parser
         self.loader = stream_loader
+        self.generator = batch_generator
+        self.storage = storage
         self.writer = data_writer
         self.stream = None
 
@@ -57,9 +64,9 @@ class DataLoader:
             data = self.parser.func(self.stream)
 
             if data is None:
-                # The stream is end. Open the new stream next time.
+                # The stream is end. Close it and open the new stream next time.
                 if self.stream is not None:
-                    del self.stream
+                    self.stream.close()
                 self.stream = None
                 continue
 
@@ -68,7 +75,11 @@ class DataLoader:
                 if random.randint(0, self.rate-1) != 0:
                     continue
 
-            self.writer.send(data)
+            # Wrap the data into one free slot of the shared storage. Only
+            # the slot index is sent back.
+            slot = self.writer.recv()
+            self.generator.store(self.storage, slot, data)
+            self.writer.send(slot)
             break
 
 class LoaderConfig:
@@ -93,7 +104,7 @@ class LoaderConfig:
             return False
         return True
 
-def __load_from_files(config, data_writer):
+def __load_from_files(config, storage, data_writer):
     # Load the data from disk. Recommand to design a heavy stream parser instead 
     # of heavy batch generator. It is because that there are N workers execute the 
     # parser function, only one worker executes generator function.
@@ -103,49 +114,62 @@ def __load_from_files(config, data_writer):
                  data_writer = data_writer,
                  down_sample_rate = config.down_sample_rate,
                  stream_loader = config.stream_loader,
-                 stream_parser = config.stream_parser
+                 stream_parser = config.stream_parser,
+                 batch_generator = config.batch_generator,
+                 storage = storage
              )
 
     while True:
         loader.next()
 
-def __gather_batch(config, data_readers, batch_writer):
-    shuf_buff = ShuffleBuffer(config.buffer_size)
+def __gather_batch(config, storage, free_slots, data_readers, batch_queue):
+    # The loader runs in the daemon thread. Pass any failure, including a dead
+    # worker, to the consumer so that the training process does not wait for
+    # a batch forever.
+    try:
+        __gather_batch_loop(config, storage, free_slots, data_readers, batch_queue)
+    except Exception as e:
+        batch_queue.put(e)
+
+def __gather_batch_loop(config, storage, free_slots, data_readers, batch_queue):
+    # The workers wrap the samples into the shared storage and send the slot
+    # indices. The shuffle buffer only keeps the indices, and every received
+    # slot is paid back with a free one.
     batch_gen = config.batch_generator
+    shuf_buff = ShuffleBuffer(config.buffer_size)
 
     stop = False
     while not stop:
         # Fill the buffer until it is full.
         for r in data_readers:
-            try:
-                item = r.recv()
-                outs = shuf_buff.insert_item_and_pop(item)
-                if outs is not None:
-                    stop = True
-            except:
-                return
+            slot = r.recv()
+            outs = shuf_buff.insert_item_and_pop(slot)
+            if outs is not None:
+                free_slots.append(outs)
+                stop = True
+            r.send(free_slots.pop())
 
     # Now, start to prepare the batch. It significantly improve
     # the loader performanc.
     while True:
-        data_list = list()
+        slot_list = list()
 
-        while len(data_list) < config.batch_size:
+        while len(slot_list) < config.batch_size:
             for r in data_readers:
-                try:
-                    item = r.recv()
-                    outs = shuf_buff.insert_item_and_pop(item)
-                    if outs is not None:
-                        data_list.append(outs)
-                except:
-                    return
-
-        # Send the batch.
-        batch = batch_gen.func(data_list)
-        try:
-            batch_writer.send(batch)
-        except:
-            return
+                slot = r.recv()
+                outs = shuf_buff.insert_item_and_pop(slot)
+                if outs is not None:
+                    slot_list.append(outs)
+                r.send(free_slots.pop())
+
+                if len(slot_list) >= config.batch_size:
+                    break
+
+        # Send the batch. The queue passes the tensors to main thread
+        # without pickling them so that the pinned buffers are kept.
+        batch = batch_gen.func(storage, slot_list)
+        free_slots.extend(slot_list)
+        batch_queue.put(batch)
 
 def LazyLoader(*args, **kwargs):
     config = LoaderConfig()
@@ -163,32 +187,43 @@ def LazyLoader(*args, **kwargs):
         print("Config is invalid. Please check your setting.")
         return None
 
+    # The storage is shared by the workers and the gather thread. It has
+    # the slots for the shuffle buffer, the current batch and the slots
+    # held by the workers.
+    storage_size = config.buffer_size + \
+                       config.batch_size + \
+                       config.num_workers * SLOTS_PER_WORKER
+    storage = config.batch_generator.new_storage(storage_size)
+    free_slots = list(range(storage_size))
+
     data_readers = list()
-    batch_reader, batch_writer = mp.Pipe(duplex=False)
+    batch_queue = queue.Queue(maxsize=1)
 
     for _ in range(config.num_workers):
-        # One process uses one pipe.
-        data_reader, data_writer = mp.Pipe(duplex=False)
+        # One process uses one pipe. The worker sends the filled slots
+        # and receives the free slots.
+        data_reader, data_writer = mp.Pipe(duplex=True)
         data_readers.append(data_reader)
 
+        for _ in range(SLOTS_PER_WORKER):
+            data_reader.send(free_slots.pop())
+
         # Create one SMP process.
         mp.Process(
             target=__load_from_files,
-            args=(config, data_writer),
+            args=(config, storage, data_writer),
             daemon=True
         ).start()
         data_writer.close()
 
     threading.Thread(
         target=__gather_batch,
-        args=(config, data_readers, batch_writer),
+        args=(config, storage, free_slots, data_readers, batch_queue),
         daemon=True
     ).start()
 
-    # Do not close it because the thread and main thread share the same
-    # writer.
-    # batch_writer.close()
-
     while True:
-        batch = batch_reader.recv()
+        batch = batch_queue.get()
+        if isinstance(batch, Exception):
+            raise RuntimeError("The data loader is stopped.") from batch
         yield batch
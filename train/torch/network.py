@@ -620,8 +620,8 @@ class Network(nn.Module):
         )
 
     def forward(self, planes, target=None, use_symm=False):
-        symm = int(np.random.choice(8, 1)[0])
         if use_symm:
+            symm = int(np.random.choice(8, 1)[0])
             planes = torch_symmetry(symm, planes, invert=False)
 
         # mask buffers
@@ -25,6 +25,22 @@ def __torch_symmetry_planes_invert(symm, planes):
         planes = torch.flip(planes, dims=(2,))
     return torch.rot90(planes, -rot,dims=(2,3))
 
+# input shape must [batch, x^2]
+def torch_symmetry_ownership(symm, ownership):
+    batch, num_intersections = ownership.shape
+    size = math.isqrt(num_intersections)
+
+    planes = torch.reshape(ownership, (batch, 1, size, size))
+    planes = __torch_symmetry_planes(symm, planes)
+    return torch.flatten(planes, start_dim=1)
+
+# input shape must [batch, x^2+1]
+def torch_symmetry_prob(symm, prob):
+    last = prob.shape[1]-1
+
+    prob_without_pass = torch_symmetry_ownership(symm, prob[:, 0:last])
+    return torch.cat((prob_without_pass, prob[:, last:]), 1)
+
 # input shape must [channel, x, y]
 def numpy_symmetry_planes(symm, plane):
     rot, use_flip = __get_direction(symm)
@@ -1,12 +1,21 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-import random, time, math, os, glob, io, gzip
+import random, time, math, os, sys, errno, glob, functools, weakref, contextlib
+from multiprocessing import shared_memory
+
+try:
+    # The isal (Intel ISA-L) gzip is much faster than the built-in
+    # one. Fall back to the built-in gzip if it is not installed.
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 from network import Network
 from data import Data, FIXED_DATA_VERSION
+from symmetry import torch_symmetry, torch_symmetry_prob, torch_symmetry_ownership
 
-from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from lazy_loader import LazyLoader
 
 def gather_filenames(root, num_chunks=None, sort_key_fn=None):
@@ -39,12 +48,12 @@ class StreamLoader:
         if not os.path.isfile(filename):
             return stream
 
+        # Return the file object directly. The parser only reads it line
+        # by line, so the data is decompressed while parsing.
         if filename.find(".gz") >= 0:
-            with gzip.open(filename, 'rt') as f:
-                stream = io.StringIO(f.read())
+            stream = gzip.open(filename, 'rt')
         else:
-            with open(filename, 'r') as f:
-                stream = io.StringIO(f.read())
+            stream = open(filename, 'r')
         return stream
 
 class StreamParser:
@@ -58,135 +67,238 @@ class StreamParser:
             return None
 
         datalines = Data.get_datalines(FIXED_DATA_VERSION);
-        data_str = []
 
-        while True:
-            for cnt in range(datalines):
-                line = stream.readline()
-                if len(line) == 0:
-                    return None # stream is end
-                else:
-                    data_str.append(line)
+        if self.down_sample_rate > 1:
+            # Roll the dice before reading the data. The dropped data are
+            # skipped without keeping or parsing them.
+            while random.randint(0, self.down_sample_rate-1) != 0:
+                for cnt in range(datalines):
+                    if len(stream.readline()) == 0:
+                        return None # stream is end
 
-            if self.down_sample_rate > 1:
-                if random.randint(0, self.down_sample_rate-1) != 0:
-                    data_str = []
-                    continue
-            break
+        data_str = []
+        for cnt in range(datalines):
+            line = stream.readline()
+            if len(line) == 0:
+                return None # stream is end
+            else:
+                data_str.append(line)
 
         data = Data()
+        data.parse_v1(data_str)
 
-        for cnt in range(datalines):
-            line = data_str[cnt]
-            data.fill_v1(cnt, line)
+        return data
+
+@functools.lru_cache(maxsize=128)
+def get_constant_planes(board_size, komi, black_to_move):
+    planes = np.zeros((4, board_size, board_size), dtype=np.float32)
+    if black_to_move:
+        planes[0] =  komi/20
+        planes[1] = -komi/20
+    else:
+        planes[0] = -komi/20
+        planes[1] =  komi/20
+    planes[2] = (board_size**2)/361
+    planes[3] = 1 # fill ones
+
+    # The planes are shared, do not modify them.
+    planes.setflags(write=False)
+    return planes
+
+def reserve_shared_memory(shm, path="/dev/shm"):
+    # The shared memory is a sparse file in /dev/shm on Linux, so its pages
+    # are allocated at the first write. The write to a full /dev/shm crashes
+    # the process with SIGBUS, e.g. 64MB in the default docker container.
+    # Allocate all pages now so that it fails here.
+    if not hasattr(os, "posix_fallocate") or not os.path.isdir(path):
+        return
+    fd = os.open(os.path.join(path, shm.name), os.O_RDWR)
+    try:
+        os.posix_fallocate(fd, 0, shm.size)
+    except OSError as e:
+        if e.errno != errno.ENOSPC:
+            return
+        raise MemoryError(
+                  "The data loader needs {:.2f}MB shared memory, but {} is full. "
+                  "Please reduce the BufferSize or enlarge {}.".format(
+                      shm.size/(1024*1024), path, path)) from e
+    finally:
+        os.close(fd)
+
+class SampleStorage:
+    def __init__(self, size, nn_board_size, num_binary_planes, name=None):
+        # The structure of arrays keeping the wrapped samples. Every sample
+        # takes one slot. Use the compact types because the shuffle buffer
+        # may be very large.
+        #
+        # All arrays are in one shared memory block so that the loader
+        # workers write the samples in place. The creator unlinks the
+        # block at exit. The workers only attach to it, so they do not
+        # track it. Before Python 3.13 they register it with the resource
+        # tracker shared with the creator, which does not unlink it early.
+        self.size = size
+        self.nn_board_size = nn_board_size
+        self.num_binary_planes = num_binary_planes
+
+        nn_num_intersections = nn_board_size * nn_board_size
+        fields = [
+            ("board_size", (size,), np.int32),
+            ("komi", (size,), np.float64),
+            ("to_move", (size,), np.int8),
+            ("planes", (size, num_binary_planes, nn_board_size, nn_board_size), np.int8),
+            ("prob", (size, nn_num_intersections+1), np.float32),
+            ("aux_prob", (size, nn_num_intersections+1), np.float32),
+            ("ownership", (size, nn_num_intersections), np.int8),
+            ("result", (size,), np.int8),
+            ("q_value", (size,), np.float32),
+            ("final_score", (size,), np.float32)
+        ]
+
+        def aligned_nbytes(shape, dtype):
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            return (nbytes + 63) // 64 * 64
+
+        if name is None:
+            total = sum(aligned_nbytes(shape, dtype) for _, shape, dtype in fields)
+            self.shm = shared_memory.SharedMemory(create=True, size=total)
+            unlink = weakref.finalize(self, self.shm.unlink)
+            try:
+                reserve_shared_memory(self.shm)
+            except MemoryError:
+                self.shm.close()
+                unlink()
+                raise
+        elif sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
 
-        data.apply_symmetry(random.randint(0, 7))
+        # The new shared memory is filled with zeros.
+        offset = 0
+        for attr, shape, dtype in fields:
+            setattr(self, attr, np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset))
+            offset += aligned_nbytes(shape, dtype)
 
-        return data
+    def __getstate__(self):
+        # Only pass the shared memory name to the other process.
+        return (self.size, self.nn_board_size, self.num_binary_planes, self.shm.name)
+
+    def __setstate__(self, state):
+        size, nn_board_size, num_binary_planes, name = state
+        self.__init__(size, nn_board_size, num_binary_planes, name)
 
 class BatchGenerator:
-    def __init__(self, boardsize, input_channels):
+    def __init__(self, boardsize, input_channels, pin_memory=False):
         self.nn_board_size = boardsize
         self.nn_num_intersections = self.nn_board_size * self.nn_board_size
         self.input_channels = input_channels
 
-    def __wrap_data(self, data):
+        # Allocate the batch in the page-locked memory so that the copy
+        # to GPU can be asynchronous.
+        self.pin_memory = bool(pin_memory)
+
+    def __alloc_buffer(self, shape):
+        return torch.zeros(shape, dtype=torch.float32, pin_memory=self.pin_memory)
+
+    def __wrap_data(self, data, storage, slot):
+        # Wrap one sample into the given slot of the storage.
         nn_board_size = self.nn_board_size
         nn_num_intersections = self.nn_num_intersections
 
         board_size = data.board_size
         num_intersections = data.board_size * data.board_size
 
-        # allocate all buffers
-        input_planes = np.zeros((self.input_channels, nn_board_size, nn_board_size))
-        prob = np.zeros(nn_num_intersections+1)
-        aux_prob = np.zeros(nn_num_intersections+1)
-        ownership = np.zeros((nn_board_size, nn_board_size))
-        wdl = np.zeros(3)
-        stm = np.zeros(1)
-        final_score = np.zeros(1)
-
-        buf = np.zeros(num_intersections)
-        sqr_buf = np.zeros((nn_board_size, nn_board_size))
-
-        # input planes
-        for p in range(self.input_channels-4):
-            plane = data.planes[p]
-            input_planes[p, 0:board_size, 0:board_size] = np.reshape(plane, (board_size, board_size))[:, :]
-
-        if data.to_move == 1:
-            input_planes[self.input_channels-4, 0:board_size, 0:board_size] =  data.komi/20
-            input_planes[self.input_channels-3, 0:board_size, 0:board_size] = -data.komi/20
+        storage.board_size[slot] = board_size
+        storage.komi[slot] = data.komi
+        storage.to_move[slot] = data.to_move
+
+        if board_size == nn_board_size:
+            # Fast path, the sample fills the whole slot.
+            storage.planes[slot] = np.reshape(data.planes, (-1, board_size, board_size))
+            storage.prob[slot] = data.prob
+            storage.aux_prob[slot] = data.aux_prob
+            storage.ownership[slot] = data.ownership
         else:
-            input_planes[self.input_channels-4, 0:board_size, 0:board_size] = -data.komi/20
-            input_planes[self.input_channels-3, 0:board_size, 0:board_size] =  data.komi/20
+            # The slot may keep the last sample. Clean the out of board area.
+            storage.planes[slot] = 0
+            storage.prob[slot] = 0
+            storage.aux_prob[slot] = 0
+            storage.ownership[slot] = 0
 
-        input_planes[self.input_channels-2, 0:board_size, 0:board_size] = (data.board_size**2)/361
-        input_planes[self.input_channels-1, 0:board_size, 0:board_size] = 1 # fill ones
+            # input planes
+            storage.planes[slot, :, 0:board_size, 0:board_size] = np.reshape(data.planes, (-1, board_size, board_size))
 
-        # probabilities
-        buf[:] = data.prob[0:num_intersections]
-        sqr_buf[0:board_size, 0:board_size] = np.reshape(buf, (board_size, board_size))[:, :]
-        prob[0:nn_num_intersections] = np.reshape(sqr_buf, (nn_num_intersections))[:]
-        prob[nn_num_intersections] = data.prob[num_intersections]
+            # probabilities
+            sqr_prob = np.reshape(storage.prob[slot, 0:nn_num_intersections], (nn_board_size, nn_board_size))
+            sqr_prob[0:board_size, 0:board_size] = np.reshape(data.prob[0:num_intersections], (board_size, board_size))
+            storage.prob[slot, nn_num_intersections] = data.prob[num_intersections]
 
-        # auxiliary probabilities
-        buf[:] = data.aux_prob[0:num_intersections]
-        sqr_buf[0:board_size, 0:board_size] = np.reshape(buf, (board_size, board_size))[:, :]
-        aux_prob[0:nn_num_intersections] = np.reshape(sqr_buf, (nn_num_intersections))[:]
-        aux_prob[nn_num_intersections] = data.aux_prob[num_intersections]
+            # auxiliary probabilities
+            sqr_aux_prob = np.reshape(storage.aux_prob[slot, 0:nn_num_intersections], (nn_board_size, nn_board_size))
+            sqr_aux_prob[0:board_size, 0:board_size] = np.reshape(data.aux_prob[0:num_intersections], (board_size, board_size))
+            storage.aux_prob[slot, nn_num_intersections] = data.aux_prob[num_intersections]
 
-        # ownership
-        ownership[0:board_size, 0:board_size] = np.reshape(data.ownership, (board_size, board_size))[:, :]
-        ownership = np.reshape(ownership, (nn_num_intersections))
+            # ownership
+            sqr_ownership = np.reshape(storage.ownership[slot], (nn_board_size, nn_board_size))
+            sqr_ownership[0:board_size, 0:board_size] = np.reshape(data.ownership, (board_size, board_size))
 
         # winrate
-        wdl[1 - data.result] = 1
-        stm[0] = data.q_value
-        final_score[0] = data.final_score
+        storage.result[slot] = data.result
+        storage.q_value[slot] = data.q_value
+        storage.final_score[slot] = data.final_score
 
-        return (
-            data.board_size,
-            input_planes,
-            prob,
-            aux_prob,
-            ownership,
-            wdl,
-            stm,
-            final_score
-        )
+    def new_storage(self, size):
+        return SampleStorage(size, self.nn_board_size, self.input_channels-4)
 
-    def func(self, data_list):
-        batch_bsize = list()
-        batch_planes = list()
-        batch_prob = list()
-        batch_aux_prob = list()
-        batch_ownership = list()
-        batch_wdl = list()
-        batch_stm = list()
-        batch_score = list()
-
-        for data in data_list:
-            bsize, planes, prob, aux_prob, ownership, wdl, stm, score = self.__wrap_data(data)
-
-            batch_bsize.append(bsize)
-            batch_planes.append(planes)
-            batch_prob.append(prob)
-            batch_aux_prob.append(aux_prob)
-            batch_ownership.append(ownership)
-            batch_wdl.append(wdl)
-            batch_stm.append(stm)
-            batch_score.append(score)
+    def store(self, storage, slot, data):
+        self.__wrap_data(data, storage, slot)
+
+    def func(self, storage, slots):
+        batch_size = len(slots)
+        nn_board_size = self.nn_board_size
+        nn_num_intersections = self.nn_num_intersections
+
+        # Allocate the whole batch once. The numpy views share memory
+        # with the tensors.
+        batch_planes = self.__alloc_buffer((batch_size, self.input_channels, nn_board_size, nn_board_size))
+        batch_prob = self.__alloc_buffer((batch_size, nn_num_intersections+1))
+        batch_aux_prob = self.__alloc_buffer((batch_size, nn_num_intersections+1))
+        batch_ownership = self.__alloc_buffer((batch_size, nn_num_intersections))
+        batch_wdl = self.__alloc_buffer((batch_size, 3))
+        batch_stm = self.__alloc_buffer((batch_size, 1))
+        batch_score = self.__alloc_buffer((batch_size, 1))
+
+        planes_view = batch_planes.numpy()
+
+        # Gather the samples from the storage. Every array is copied
+        # with one indexing.
+        slots = np.array(slots)
+        batch_bsize = storage.board_size[slots].tolist()
+
+        planes_view[:, 0:self.input_channels-4] = storage.planes[slots]
+        batch_prob.numpy()[:] = storage.prob[slots]
+        batch_aux_prob.numpy()[:] = storage.aux_prob[slots]
+        batch_ownership.numpy()[:] = storage.ownership[slots]
+        batch_wdl.numpy()[np.arange(batch_size), 1 - storage.result[slots]] = 1
+        batch_stm.numpy()[:, 0] = storage.q_value[slots]
+        batch_score.numpy()[:, 0] = storage.final_score[slots]
+
+        # The last four planes only depend on the board size, komi and
+        # side to move. Copy them from the cache.
+        for i, s in enumerate(slots):
+            board_size = batch_bsize[i]
+            planes_view[i, self.input_channels-4:, 0:board_size, 0:board_size] = \
+                get_constant_planes(board_size, float(storage.komi[s]), storage.to_move[s] == 1)
 
         return (
             batch_bsize,
-            torch.tensor(np.array(batch_planes)).float(),
-            torch.tensor(np.array(batch_prob)).float(),
-            torch.tensor(np.array(batch_aux_prob)).float(),
-            torch.tensor(np.array(batch_ownership)).float(),
-            torch.tensor(np.array(batch_wdl)).float(),
-            torch.tensor(np.array(batch_stm)).float(),
-            torch.tensor(np.array(batch_score)).float()
+            batch_planes,
+            batch_prob,
+            batch_aux_prob,
+            batch_ownership,
+            batch_wdl,
+            batch_stm,
+            batch_score
         )
 
 class TrainingPipe():
@@ -230,11 +342,28 @@ class TrainingPipe():
         self.weight_decay = cfg.weight_decay
         self.lr_schedule = cfg.lr_schedule
 
+        # The distributed training setting. Launch the training with
+        # torchrun to use multiple GPUs, one process per GPU.
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.rank = int(os.environ.get("RANK", 0))
+        self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+        # Only the main process validates, stores and logs.
+        self.is_main = self.rank == 0
+
         # The training device.
         self.use_gpu = cfg.use_gpu
+        self.use_ddp = self.use_gpu and self.world_size > 1
+        assert self.use_gpu or self.world_size == 1, "The distributed training needs GPU."
+        assert self.macrobatchsize % self.world_size == 0, \
+                   "The macro batch size must be divisible by the number of processes."
         self.device = torch.device('cpu')
         if self.use_gpu:
-            self.device = torch.device('cuda')
+            self.device = torch.device('cuda', self.local_rank)
+            torch.cuda.set_device(self.device)
+
+        # Use the bfloat16 mixed precision if the GPU supports it.
+        self.use_bf16 = self.use_gpu and torch.cuda.is_bf16_supported()
         self.net = Network(cfg)
         self.net.trainable(True)
 
@@ -247,9 +376,25 @@ class TrainingPipe():
         self.module = self.net # linking
 
         if self.use_gpu:
-            self.net = self.net.to(self.device)
-            self.net = DataParallel(self.net) 
-            self.module  = self.net.module
+            # The cuDNN convolution is faster with the channels last
+            # (NHWC) layout.
+            self.net = self.net.to(self.device, memory_format=torch.channels_last)
+            if self.use_ddp:
+                torch.distributed.init_process_group('nccl')
+                self.net = DistributedDataParallel(self.net, device_ids=[self.local_rank])
+                self.module  = self.net.module
+
+        # Compile the training graph. The batch shape is fixed, so it is
+        # specialized to this shape. Fall back to the eager mode for the
+        # old version PyTorch. The graph is compiled lazily, so the first
+        # training step is also guarded.
+        self.compiled_net = self.net
+        if self.use_gpu:
+            try:
+                self.compiled_net = torch.compile(self.net, mode='max-autotune', dynamic=False)
+            except Exception:
+                print("Fail to compile the network. Use the eager mode.")
+        self.compile_verified = self.compiled_net is self.net
 
         init_lr = self.__get_lr_schedule(0)
 
@@ -273,6 +418,9 @@ class TrainingPipe():
                 weight_decay=self.weight_decay,
             )
 
+        if not self.is_main:
+            return
+
         model_path = os.path.join(self.store_path, "model")
         if not os.path.isdir(model_path):
             os.mkdir(model_path)
@@ -334,6 +482,9 @@ class TrainingPipe():
         return last_steps
 
     def __store_current_status(self, steps):
+        if not self.is_main:
+            return
+
         steps_name = os.path.join(self.store_path, "last_steps.txt")
         with open(steps_name, 'w') as f:
             f.write(str(steps))
@@ -351,34 +502,42 @@ class TrainingPipe():
     def __init_loader(self):
         self.__stream_loader = StreamLoader()
         self.__stream_parser = StreamParser(self.down_sample_rate)
-        self.__batch_gen = BatchGenerator(self.cfg.boardsize, self.cfg.input_channels)
+        self.__batch_gen = BatchGenerator(self.cfg.boardsize, self.cfg.input_channels, self.use_gpu)
 
         sort_fn = os.path.getmtime
         chunks = gather_filenames(self.train_dir, self.num_chunks, sort_fn)
+        assert len(chunks) >= self.world_size, "Every process needs at least one chunk."
+
+        # Every process reads the disjoint shard of the chunks and takes
+        # its part of the batch. The workers and buffers are also split so
+        # that the machine runs the same number of workers.
+        num_workers = max(self.num_workers // self.world_size, 1)
+        train_buffer_size = max(self.train_buffer_size // self.world_size, 1)
+        validation_buffer_size = max(self.validation_buffer_size // self.world_size, 1)
 
         self.train_lazy_loader = LazyLoader(
-            filenames = chunks,
+            filenames = chunks[self.rank::self.world_size],
             stream_loader = self.__stream_loader,
             stream_parser = self.__stream_parser,
             batch_generator = self.__batch_gen,
             down_sample_rate = 0,
-            num_workers = self.num_workers,
-            buffer_size = self.train_buffer_size,
-            batch_size = self.macrobatchsize
+            num_workers = num_workers,
+            buffer_size = train_buffer_size,
+            batch_size = self.macrobatchsize // self.world_size
         )
 
         # Try to get the first batch, be sure that the loader is ready.
         batch = next(self.train_lazy_loader)
 
-        if self.validation_dir is not None:
+        if self.validation_dir is not None and self.is_main:
             self.validation_lazy_loader = LazyLoader(
                 filenames = gather_filenames(self.validation_dir, len(chunks)//10, sort_fn),
                 stream_loader = self.__stream_loader,
                 stream_parser = self.__stream_parser,
                 batch_generator = self.__batch_gen,
                 down_sample_rate = 0,
-                num_workers = self.num_workers,
-                buffer_size = self.validation_buffer_size,
+                num_workers = num_workers,
+                buffer_size = validation_buffer_size,
                 batch_size = self.macrobatchsize
             )
             batch = next(self.validation_lazy_loader)
@@ -387,17 +546,29 @@ class TrainingPipe():
 
 
     def get_new_running_loss_dict(self):
-        # Get the new dict.
+        # Get the new dict. The losses are accumulated on the device so
+        # that we don't synchronize the device every step.
         running_loss_dict = dict()
-        running_loss_dict['loss'] = 0
-        running_loss_dict['prob_loss'] = 0
-        running_loss_dict['aux_prob_loss'] = 0
-        running_loss_dict['ownership_loss'] = 0
-        running_loss_dict['wdl_loss'] = 0
-        running_loss_dict['stm_loss'] = 0
-        running_loss_dict['final_score_loss'] = 0
+        running_loss_dict['loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['prob_loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['aux_prob_loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['ownership_loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['wdl_loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['stm_loss'] = torch.zeros((), device=self.device)
+        running_loss_dict['final_score_loss'] = torch.zeros((), device=self.device)
         return running_loss_dict
 
+    def gather_running_loss(self, running_loss_dict, all_ranks=False):
+        # Copy the accumulated losses to host. If all_ranks is set, every
+        # process must call it, and the losses are averaged over all
+        # processes, so every process sees the same global loss.
+        keys = list(running_loss_dict.keys())
+        losses = torch.stack([running_loss_dict[k] for k in keys])
+        if self.use_ddp and all_ranks:
+            torch.distributed.all_reduce(losses)
+            losses = losses / self.world_size
+        return dict(zip(keys, losses.tolist()))
+
     def gather_data_from_loader(self, use_training=True):
         # Fetch the next batch data from disk.
         if use_training:
@@ -407,15 +578,27 @@ class TrainingPipe():
 
         _, planes, target_prob, target_aux_prob, target_ownership, target_wdl, target_stm, target_score = batch
 
-        # Move the data to the current device.
+        # Move the data to the current device. The batch is in pinned memory, so
+        # the copies are queued on the current stream and overlap with the compute.
+        if self.use_gpu:
+            planes = planes.to(self.device, non_blocking=True)
+            target_prob = target_prob.to(self.device, non_blocking=True)
+            target_aux_prob = target_aux_prob.to(self.device, non_blocking=True)
+            target_ownership = target_ownership.to(self.device, non_blocking=True)
+            target_wdl = target_wdl.to(self.device, non_blocking=True)
+            target_stm = target_stm.to(self.device, non_blocking=True)
+            target_score = target_score.to(self.device, non_blocking=True)
+
+        # Apply one random symmetry to the whole batch on the current device.
+        symm = random.randint(0, 7)
+        planes = torch_symmetry(symm, planes)
+        target_prob = torch_symmetry_prob(symm, target_prob)
+        target_aux_prob = torch_symmetry_prob(symm, target_aux_prob)
+        target_ownership = torch_symmetry_ownership(symm, target_ownership)
+
         if self.use_gpu:
-            planes = planes.to(self.device)
-            target_prob = target_prob.to(self.device)
-            target_aux_prob = target_aux_prob.to(self.device)
-            target_ownership = target_ownership.to(self.device)
-            target_wdl = target_wdl.to(self.device)
-            target_stm = target_stm.to(self.device)
-            target_score = target_score.to(self.device)
+            # Match the channels last layout of the network.
+            planes = planes.contiguous(memory_format=torch.channels_last)
 
         # Gather batch data
         target = (target_prob, target_aux_prob, target_ownership, target_wdl, target_stm, target_score)
@@ -433,19 +616,21 @@ class TrainingPipe():
 
         for _ in range(total_steps):
             planes, target = self.gather_data_from_loader(False)
-            _, all_loss = self.net(planes, target, use_symm=True)
+            _, all_loss = self.module(planes, target, use_symm=False)
             prob_loss, aux_prob_loss, ownership_loss, wdl_loss, stm_loss, final_score_loss = all_loss
             
             loss = prob_loss + aux_prob_loss + ownership_loss + wdl_loss + stm_loss + final_score_loss
 
             # accumulate loss
-            running_loss_dict['loss'] += loss.mean().item()
-            running_loss_dict['prob_loss'] += prob_loss.mean().item()
-            running_loss_dict['aux_prob_loss'] += aux_prob_loss.mean().item()
-            running_loss_dict['ownership_loss'] += ownership_loss.mean().item()
-            running_loss_dict['wdl_loss'] += wdl_loss.mean().item()
-            running_loss_dict['stm_loss'] += stm_loss.mean().item()
-            running_loss_dict['final_score_loss'] += final_score_loss.mean().item()
+            running_loss_dict['loss'] += loss.mean().detach()
+            running_loss_dict['prob_loss'] += prob_loss.mean().detach()
+            running_loss_dict['aux_prob_loss'] += aux_prob_loss.mean().detach()
+            running_loss_dict['ownership_loss'] += ownership_loss.mean().detach()
+            running_loss_dict['wdl_loss'] += wdl_loss.mean().detach()
+            running_loss_dict['stm_loss'] += stm_loss.mean().detach()
+            running_loss_dict['final_score_loss'] += final_score_loss.mean().detach()
+
+        running_loss_dict = self.gather_running_loss(running_loss_dict)
 
         log_outs = "steps: {} -> ".format(steps)
         log_outs += "speed: {:.2f}, opt: {}, learning rate: {}, batch size: {}\n".format(
@@ -466,6 +651,38 @@ class TrainingPipe():
             f.write(log_outs + '\n')
         self.module.trainable(True)
 
+    def __forward_and_backward(self, planes, target):
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_bf16):
+            _, all_loss = self.compiled_net(planes, target, use_symm=False)
+
+        prob_loss, aux_prob_loss, ownership_loss, wdl_loss, stm_loss, final_score_loss = all_loss
+
+        # compute loss, keep the reduction in float32
+        prob_loss = prob_loss.float().mean() / self.macrofactor
+        aux_prob_loss = aux_prob_loss.float().mean() / self.macrofactor
+        ownership_loss = ownership_loss.float().mean() / self.macrofactor
+        wdl_loss = wdl_loss.float().mean() / self.macrofactor
+        stm_loss = stm_loss.float().mean() / self.macrofactor
+        final_score_loss = final_score_loss.float().mean() / self.macrofactor
+
+        loss = prob_loss + aux_prob_loss + ownership_loss + wdl_loss + stm_loss + final_score_loss
+        loss.backward()
+
+        return loss, prob_loss, aux_prob_loss, ownership_loss, wdl_loss, stm_loss, final_score_loss
+
+    def __train_step(self, planes, target):
+        # The compiled graph is built at the first forward and backward
+        # call. Fall back to the eager mode if it fails.
+        if not self.compile_verified:
+            self.compile_verified = True
+            try:
+                return self.__forward_and_backward(planes, target)
+            except Exception:
+                print("Fail to compile the network. Use the eager mode.")
+                self.compiled_net = self.net
+                self.opt.zero_grad()
+        return self.__forward_and_backward(planes, target)
+
     def fit_and_store(self):
         init_steps = self.__load_current_status()
 
@@ -476,6 +693,7 @@ class TrainingPipe():
         running_loss_dict = self.get_new_running_loss_dict()
         num_steps = init_steps
         keep_running = True
+        explosion = False
         macro_steps = 0
 
         clock_time = time.time()
@@ -484,36 +702,24 @@ class TrainingPipe():
             for _ in range(self.steps_per_epoch):
                 planes, target = self.gather_data_from_loader(True)
 
-                # forward and backforwad
-                _, all_loss = self.net(planes, target, use_symm=True)
-
-                prob_loss, aux_prob_loss, ownership_loss, wdl_loss, stm_loss, final_score_loss = all_loss
-
-                # compute loss
-                prob_loss = prob_loss.mean() / self.macrofactor
-                aux_prob_loss = aux_prob_loss.mean() / self.macrofactor
-                ownership_loss = ownership_loss.mean() / self.macrofactor
-                wdl_loss = wdl_loss.mean() / self.macrofactor
-                stm_loss = stm_loss.mean() / self.macrofactor
-                final_score_loss = final_score_loss.mean() / self.macrofactor
-
-                loss = prob_loss + aux_prob_loss + ownership_loss + wdl_loss + stm_loss + final_score_loss
-                loss.backward()
+                # forward and backforwad, only synchronize the gradients
+                # at the last micro step
+                sync_context = contextlib.nullcontext()
+                if self.use_ddp and (macro_steps + 1) % self.macrofactor != 0:
+                    sync_context = self.net.no_sync()
+                with sync_context:
+                    loss, prob_loss, aux_prob_loss, ownership_loss, wdl_loss, stm_loss, final_score_loss = \
+                        self.__train_step(planes, target)
                 macro_steps += 1
 
                 # accumulate loss
-                running_loss_dict['loss'] += loss.item()
-                running_loss_dict['prob_loss'] += prob_loss.item()
-                running_loss_dict['aux_prob_loss'] += aux_prob_loss.item()
-                running_loss_dict['ownership_loss'] += ownership_loss.item()
-                running_loss_dict['wdl_loss'] += wdl_loss.item()
-                running_loss_dict['stm_loss'] += stm_loss.item()
-                running_loss_dict['final_score_loss'] += final_score_loss.item()
-
-                if math.isnan(running_loss_dict['loss']):
-                    print("The gradient is explosion. Stop the training...")
-                    keep_running = False
-                    break
+                running_loss_dict['loss'] += loss.detach()
+                running_loss_dict['prob_loss'] += prob_loss.detach()
+                running_loss_dict['aux_prob_loss'] += aux_prob_loss.detach()
+                running_loss_dict['ownership_loss'] += ownership_loss.detach()
+                running_loss_dict['wdl_loss'] += wdl_loss.detach()
+                running_loss_dict['stm_loss'] += stm_loss.detach()
+                running_loss_dict['final_score_loss'] += final_score_loss.detach()
 
                 if macro_steps % self.macrofactor == 0:
                     # clip grad
@@ -529,8 +735,20 @@ class TrainingPipe():
                     for param in self.opt.param_groups:
                         param["lr"] = self.__get_lr_schedule(num_steps) 
 
-                    # dump the verbose
+                    # check and dump the verbose
                     if num_steps % self.verbose_steps == 0:
+                        running_loss = self.gather_running_loss(running_loss_dict, all_ranks=True)
+                        running_loss_dict = self.get_new_running_loss_dict()
+
+                        if math.isnan(running_loss['loss']):
+                            # The network may be broken after the last updates. Do
+                            # not store it.
+                            print("The gradient is explosion. Stop the training...")
+                            keep_running = False
+                            explosion = True
+                            break
+
+                    if num_steps % self.verbose_steps == 0 and self.is_main:
                         elapsed = time.time() - clock_time
                         clock_time = time.time()
 
@@ -540,13 +758,13 @@ class TrainingPipe():
                                         self.opt_name,
                                         self.opt.param_groups[0]["lr"],
                                         self.batchsize)
-                        log_outs += "\tloss: {:.4f}\n".format(running_loss_dict['loss']/self.verbose_steps)
-                        log_outs += "\tprob loss: {:.4f}\n".format(running_loss_dict['prob_loss']/self.verbose_steps)
-                        log_outs += "\taux prob loss: {:.4f}\n".format(running_loss_dict['aux_prob_loss']/self.verbose_steps)
-                        log_outs += "\townership loss: {:.4f}\n".format(running_loss_dict['ownership_loss']/self.verbose_steps)
-                        log_outs += "\twdl loss: {:.4f}\n".format(running_loss_dict['wdl_loss']/self.verbose_steps)
-                        log_outs += "\tstm loss: {:.4f}\n".format(running_loss_dict['stm_loss']/self.verbose_steps)
-                        log_outs += "\tfinal score loss: {:.4f}".format(running_loss_dict['final_score_loss']/self.verbose_steps)
+                        log_outs += "\tloss: {:.4f}\n".format(running_loss['loss']/self.verbose_steps)
+                        log_outs += "\tprob loss: {:.4f}\n".format(running_loss['prob_loss']/self.verbose_steps)
+                        log_outs += "\taux prob loss: {:.4f}\n".format(running_loss['aux_prob_loss']/self.verbose_steps)
+                        log_outs += "\townership loss: {:.4f}\n".format(running_loss['ownership_loss']/self.verbose_steps)
+                        log_outs += "\twdl loss: {:.4f}\n".format(running_loss['wdl_loss']/self.verbose_steps)
+                        log_outs += "\tstm loss: {:.4f}\n".format(running_loss['stm_loss']/self.verbose_steps)
+                        log_outs += "\tfinal score loss: {:.4f}".format(running_loss['final_score_loss']/self.verbose_steps)
                         print(log_outs)
 
                         # Also save the current running loss.
@@ -554,13 +772,15 @@ class TrainingPipe():
                         with open(log_file, 'a') as f:
                             f.write(log_outs + '\n')
 
-                        running_loss_dict = self.get_new_running_loss_dict()
-
                 # should we stop it?
                 if num_steps >= self.max_steps + init_steps:
                     keep_running = False
                     break
 
             # store the last network
-            self.__store_current_status(num_steps)
+            if not explosion:
+                self.__store_current_status(num_steps)
+
+        if self.use_ddp:
+            torch.distributed.destroy_process_group()
         print("Training is over.")